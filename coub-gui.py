@@ -75,6 +75,7 @@ def translate_to_cli(options):
     options.aac = AAC_LABEL[options.aac]
     options.recoubs = RECOUB_LABEL[options.recoubs]
     options.share, options.v_only, options.a_only = SPECIAL_LABEL[options.special]
+    options.output_exts = coub.output_exts(options)
 
     return options
 
@@ -202,10 +203,10 @@ def parse_cli():
     formats.add_argument("--a-quality", choices=["Best quality", "Worst quality"],
                          default=defs.QUALITY_LABEL[defs.A_QUALITY],
                          metavar="Audio Quality", help="Which audio quality to download")
-    formats.add_argument("--v-max", choices=["med", "high", "higher"],
+    formats.add_argument("--v-max", choices=list(coub.video_formats),
                          default=defs.V_MAX, metavar="Max. Video Quality",
                          help="Cap the max. video quality considered for download")
-    formats.add_argument("--v-min", choices=["med", "high", "higher"],
+    formats.add_argument("--v-min", choices=list(coub.video_formats),
                          default=defs.V_MIN, metavar="Min. Video Quality",
                          help="Cap the min. video quality considered for download")
     formats.add_argument("--aac", default=defs.AAC_LABEL[defs.AAC],
@@ -230,7 +231,7 @@ def parse_cli():
                         })
     output.add_argument("--merge-ext", default=defs.MERGE_EXT,
                         metavar="Output Container",
-                        choices=["mkv", "mp4", "asf", "avi", "flv", "f4v", "mov"],
+                        choices=list(coub.merge_exts),
                         help="What extension to use for merged output files "
                              "(has no effect if no merge is required)")
     output.add_argument("--name-template", default=defs.NAME_TEMPLATE,
@@ -286,6 +287,9 @@ def parse_cli():
     # but internally the default value is None
     if args.name_template == "%id%":
         args.name_template = None
+    args.name_fields = coub.template_fields(args.name_template)
+    args.v_formats = coub.allowed_formats(args.v_min, args.v_max)
+    args.preview_command = args.preview.split(" ") if args.preview else []
     # Defining whitespace or an empty string in the config isn't possible
     # Instead translate appropriate keywords
     if args.tag_sep == "space":
@@ -294,6 +298,8 @@ def parse_cli():
         args.fallback_char = ""
     elif args.fallback_char == "space":
         args.fallback_char = " "
+    args.forbidden_table = str.maketrans(
+        dict.fromkeys(coub.forbidden_chars, args.fallback_char))
 
     return translate_to_cli(args)
 
@@ -21,9 +21,15 @@ import argparse
 import asyncio
 import json
 import os
+import random
+import re
+import shutil
 import subprocess
 import sys
+import time
 
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import suppress
 from math import ceil
 from ssl import SSLCertVerificationError
 from textwrap import dedent
@@ -39,6 +45,20 @@ try:
 except ModuleNotFoundError:
     aio = False
 
+# aiofiles moves file writes off the event loop, but isn't required
+try:
+    import aiofiles
+    aio_files = True
+except ModuleNotFoundError:
+    aio_files = False
+
+# orjson parses API responses considerably faster, but isn't required
+# Its JSONDecodeError is a subclass of the one from the json module
+try:
+    from orjson import loads as json_loads
+except ModuleNotFoundError:
+    from json import loads as json_loads
+
 # ANSI escape codes don't work on Windows, unless the user jumps through
 # additional hoops (either by using 3rd-party software or enabling VT100
 # emulation with Windows 10)
@@ -98,6 +118,125 @@ if not colors:
 total = 0
 count = 0
 done = 0
+# Status line prefix of processed coubs, its width depends on total
+status_line = None
+
+# Allowed values for --max-video/--min-video and --ext
+video_formats = ("med", "high", "higher")
+# Video formats ordered from worst to best quality
+video_ranks = {f: i for i, f in enumerate(video_formats)}
+merge_exts = ("mkv", "mp4", "asf", "avi", "flv", "f4v", "mov")
+
+# Special strings supported by the output name template
+name_specials = ("%id%", "%title%", "%creation%", "%channel%", "%tags%",
+                 "%community%")
+name_pattern = re.compile("|".join(name_specials))
+
+# Coub infos found in timeline pages (by coub ID)
+# Only used if they include everything stream_lists() and get_name() need
+# and reduced to exactly that (see timeline_info())
+timeline_infos = {}
+timeline_versions = ("html5", "mobile", "share")
+
+# Audio versions in order of preference (worst to best quality)
+# With AAC preferred, the mobile version gets moved to the top spot
+audio_combos = (("html5", "med"), ("mobile", 0), ("html5", "high"))
+audio_combos_aac = (("html5", "med"), ("html5", "high"), ("mobile", 0))
+
+# URL suffixes of the different link types and the sort order they imply
+# Checked in order by normalize_link()
+link_suffixes = {
+    'channel': (
+        ('/coubs', None),
+        ('/reposts', None),
+        ('/stories', None),
+    ),
+    'tag': (
+        ('/likes', "top"),
+        ('/views', "views_count"),
+        ('/fresh', "fresh"),
+    ),
+    'search': (
+        ('/likes', "top"),
+        ('/views', "views_count"),
+        ('/fresh', "most_recent"),
+        ('/channels', None),
+    ),
+    'community': (
+        ('/rising', "rising"),
+        ('/fresh', "fresh"),
+        ('/top', "top"),
+        ('/views', "views_count"),
+        ('/random', "random"),
+    ),
+    'featured': (
+        ('featured/coubs/top_of_the_month', "top_of_the_month"),
+        ('featured/coubs/undervalued', "undervalued"),
+        ('featured/stories', None),
+        ('featured/channels', None),
+        ('featured', "recent"),
+    ),
+    'random': (
+        ('/top', "top"),
+    ),
+}
+
+# Coub links inside input lists, captures the ID
+list_links = re.compile(r"https://coub\.com/view/(\S+)")
+
+# Time (monotonic) of the last successful connection test
+last_connection = float("-inf")
+
+# Names of all files in the destination directory
+existing_files = set()
+
+# An attempt to remove the most blatant problematic characters from names
+# Linux supports all except /, but \n and \t are only asking for trouble
+# https://dwheeler.com/essays/fixing-unix-linux-filenames.html
+# ' used to break FFmpeg's concat muxer (no longer used), but is still
+# replaced to keep names of existing downloads stable
+forbidden_chars = "\n\t'/"
+if os.name == "nt":
+    forbidden_chars += "<>:\"\\|?*"
+
+# Maximum length of a filename in bytes (most common filesystems)
+# or UTF-16 code units (Windows)
+# Replaced by the destination's own limit, if it can be determined
+name_max = 255
+# Maximum length of a full path on Windows (MAX_PATH)
+path_max = 260
+
+# Bounds concurrent FFmpeg processes (stream validation and merging)
+ffmpeg_slots = None
+# Keeps previews from playing on top of each other
+preview_lock = None
+# Archive file, kept open while downloading instead of reopened per coub
+archive_file = None
+
+# Typical FFmpeg error messages in case of missing chunks
+# "Header missing"/"Failed to read frame size" -> audio corruption
+# "Invalid NAL" -> video corruption
+# "moov atom not found" -> old Coub storage method
+stream_errors = re.compile(
+    "Header missing|Failed to read frame size|Invalid NAL|moov atom not found"
+)
+
+# FFmpeg's time duration syntax
+#   [-][HH:]MM:SS[.m...][s|ms|us]
+#   [-]S+[.m...][s|ms|us]
+time_syntax = re.compile(
+    r"-?(?:(?:\d+:)?[0-5]?\d:[0-5]?\d|\d+)(?:\.\d*)?(?:s|ms|us)?"
+)
+
+# Accepted answers to the overwrite prompt (case-insensitive)
+overwrite_answers = {
+    "1": True,
+    "2": False,
+    "y": True,
+    "n": False,
+    "yes": True,
+    "no": False,
+}
 
 # ~~~~~~~~~~~~~~~~~~~~~~~~~~~~
 # Classes
@@ -142,7 +281,7 @@ class DefaultOptions:
     TAG_SEP = "_"
     FALLBACK_CHAR = "-"
     WRITE_METHOD = "w"
-    CHUNK_SIZE = 1024
+    CHUNK_SIZE = 65536
 
     def __init__(self, config_dirs=None):
         if not config_dirs:
@@ -177,7 +316,7 @@ class DefaultOptions:
     def check_values(self):
         """Test defaults for valid ranges and types."""
         checks = {
-            "VERBOSITY": (lambda x: x in [0, 1]),
+            "VERBOSITY": (lambda x: x in {0, 1}),
             "PROMPT": (lambda x: True),     # Anything but yes/no will lead to prompt
             "PATH": (lambda x: isinstance(x, str)),
             "KEEP": (lambda x: isinstance(x, bool)),
@@ -186,25 +325,25 @@ class DefaultOptions:
             "CONNECTIONS": (lambda x: isinstance(x, int) and x > 0),
             "RETRIES": (lambda x: isinstance(x, int)),
             "MAX_COUBS": (lambda x: isinstance(x, int) and x > 0 or x is None),
-            "V_QUALITY": (lambda x: x in [0, -1]),
-            "A_QUALITY": (lambda x: x in [0, -1]),
-            "V_MAX": (lambda x: x in ["higher", "high", "med"]),
-            "V_MIN": (lambda x: x in ["higher", "high", "med"]),
-            "AAC": (lambda x: x in [0, 1, 2, 3]),
+            "V_QUALITY": (lambda x: x in {0, -1}),
+            "A_QUALITY": (lambda x: x in {0, -1}),
+            "V_MAX": (lambda x: x in video_formats),
+            "V_MIN": (lambda x: x in video_formats),
+            "AAC": (lambda x: x in {0, 1, 2, 3}),
             "SHARE": (lambda x: isinstance(x, bool)),
-            "RECOUBS": (lambda x: x in [0, 1, 2]),
+            "RECOUBS": (lambda x: x in {0, 1, 2}),
             "PREVIEW": (lambda x: isinstance(x, str) or x is None),
             "A_ONLY": (lambda x: isinstance(x, bool)),
             "V_ONLY": (lambda x: isinstance(x, bool)),
             "OUTPUT_LIST": (lambda x: isinstance(x, str) or x is None),
             "ARCHIVE": (lambda x: isinstance(x, str) or x is None),
-            "MERGE_EXT": (lambda x: x in ["mkv", "mp4", "asf", "avi", "flv", "f4v", "mov"]),
+            "MERGE_EXT": (lambda x: x in merge_exts),
             "NAME_TEMPLATE": (lambda x: isinstance(x, str) or x is None),
             "FFMPEG_PATH": (lambda x: isinstance(x, str)),
             "COUBS_PER_PAGE": (lambda x: x in range(1, 26)),
             "TAG_SEP": (lambda x: isinstance(x, str)),
             "FALLBACK_CHAR": (lambda x: isinstance(x, str) or x is None),
-            "WRITE_METHOD": (lambda x: x in ["w", "a"]),
+            "WRITE_METHOD": (lambda x: x in {"w", "a"}),
             "CHUNK_SIZE": (lambda x: isinstance(x, int) and x > 0),
         }
 
@@ -228,7 +367,7 @@ class DefaultOptions:
         }
         # Some options should not undergo integer conversion
         # Usually options which are supposed to ONLY take strings
-        exceptions = [
+        exceptions = {
             "PATH",
             "DURATION",
             "PREVIEW",
@@ -238,7 +377,7 @@ class DefaultOptions:
             "FFMPEG_PATH",
             "TAG_SEP",
             "FALLBACK_CHAR",
-        ]
+        }
 
         if string in specials:
             return specials[string]
@@ -528,15 +667,23 @@ class BaseContainer:
         """Placeholder function, which must be overwritten by subclasses."""
         self.template = ""
 
-    def get_page_count(self):
+    async def get_page_count(self, session=None):
         """Contact API once to get page count and check validity."""
         if not self.valid:
             return
 
-        try:
-            with urlopen(self.template) as resp:
-                resp_json = json.loads(resp.read())
-        except urllib.error.HTTPError:
+        resp_json = None
+        if aio:
+            async with session.get(self.template) as resp:
+                if resp.status < 400:
+                    resp_json = json_loads(await resp.read())
+        else:
+            loop = asyncio.get_running_loop()
+            with suppress(urllib.error.HTTPError):
+                resp_json = json_loads(
+                    await loop.run_in_executor(None, read_url, self.template))
+
+        if resp_json is None:
             err(f"\nInvalid {self.type} ('{self.id}')!",
                 color=fgcolors.WARNING)
             self.valid = False
@@ -544,15 +691,20 @@ class BaseContainer:
 
         self.pages = resp_json['total_pages']
 
-    async def process(self, quantity=None):
+    async def prepare(self, session=None):
+        """Build the API template and request the page count."""
+        self.get_template()
+        await self.get_page_count(session)
+
+    async def process(self, quantity=None, session=None):
         """
         Parse the coub links from tags, channels, etc.
 
         The Coub API refers to the list of coubs from a tag, channel,
         community, etc. as a timeline.
+
+        prepare() must be awaited first.
         """
-        self.get_template()
-        self.get_page_count()
         if not self.valid:
             return []
 
@@ -566,7 +718,8 @@ class BaseContainer:
             if pages > max_pages:
                 pages = max_pages
 
-        requests = [f"{self.template}&page={p}" for p in range(1, pages+1)]
+        base = f"{self.template}&page="
+        requests = [base + str(p) for p in range(1, pages+1)]
 
         msg(f"\nDownloading {self.type} info"
             f"{f': {self.id}' if self.id else ''}"
@@ -575,12 +728,19 @@ class BaseContainer:
         if aio:
             msg(f"  {pages} out of {self.pages} pages")
 
-            tout = aiohttp.ClientTimeout(total=None)
-            conn = aiohttp.TCPConnector(limit=opts.connections)
-            async with aiohttp.ClientSession(timeout=tout, connector=conn) as session:
-                tasks = [parse_page(req, session) for req in requests]
-                ids = await asyncio.gather(*tasks)
-            ids = [i for page in ids for i in page]
+            # Don't fire all page requests at once, only as many as
+            # there are connections
+            # Workers share one iterator, so no task gets created per page
+            results = [[] for _ in requests]
+            queue = iter(enumerate(requests))
+
+            async def parse_worker():
+                for i, req in queue:
+                    results[i] = await parse_page(req, session)
+
+            workers = min(opts.connections, pages)
+            await gather_tasks([parse_worker() for _ in range(workers)])
+            ids = [i for page in results for i in page]
         else:
             ids = []
             for i in range(pages):
@@ -596,6 +756,14 @@ class BaseContainer:
 class Channel(BaseContainer):
     """Store and parse channels."""
     type = "channel"
+    # Sort orders and their API equivalent
+    methods = {
+        'most_recent': "newest",
+        'most_liked': "likes_count",
+        'most_viewed': "views_count",
+        'oldest': "oldest",
+        'random': "random",
+    }
 
     def __init__(self, id_):
         super(Channel, self).__init__(id_)
@@ -606,14 +774,6 @@ class Channel(BaseContainer):
 
     def get_template(self):
         """Return API request template for channels."""
-        methods = {
-            'most_recent': "newest",
-            'most_liked': "likes_count",
-            'most_viewed': "views_count",
-            'oldest': "oldest",
-            'random': "random",
-        }
-
         template = f"https://coub.com/api/v2/timeline/channel/{urlquote(self.id)}"
         template = f"{template}?per_page={opts.coubs_per_page}"
 
@@ -622,8 +782,9 @@ class Channel(BaseContainer):
         elif opts.recoubs == 2:
             template = f"{template}&type=recoubs"
 
-        if self.sort in methods:
-            template = f"{template}&order_by={methods[self.sort]}"
+        order = self.methods.get(self.sort)
+        if order is not None:
+            template = f"{template}&order_by={order}"
         else:
             err(f"\nInvalid channel sort order '{self.sort}' ({self.id})!",
                 color=fgcolors.WARNING)
@@ -635,6 +796,13 @@ class Channel(BaseContainer):
 class Tag(BaseContainer):
     """Store and parse tags."""
     type = "tag"
+    # Sort orders and their API equivalent
+    methods = {
+        'popular': "newest_popular",
+        'top': "likes_count",
+        'views_count': "views_count",
+        'fresh': "newest"
+    }
 
     def __init__(self, id_):
         super(Tag, self).__init__(id_)
@@ -645,18 +813,12 @@ class Tag(BaseContainer):
 
     def get_template(self):
         """Return API request template for tags."""
-        methods = {
-            'popular': "newest_popular",
-            'top': "likes_count",
-            'views_count': "views_count",
-            'fresh': "newest"
-        }
-
         template = f"https://coub.com/api/v2/timeline/tag/{urlquote(self.id)}"
         template = f"{template}?per_page={opts.coubs_per_page}"
 
-        if self.sort in methods:
-            template = f"{template}&order_by={methods[self.sort]}"
+        order = self.methods.get(self.sort)
+        if order is not None:
+            template = f"{template}&order_by={order}"
         else:
             err(f"\nInvalid tag sort order '{self.sort}' ({self.id})!",
                 color=fgcolors.WARNING)
@@ -664,8 +826,8 @@ class Tag(BaseContainer):
 
         self.template = template
 
-    def get_page_count(self):
-        super(Tag, self).get_page_count()
+    async def get_page_count(self, session=None):
+        await super(Tag, self).get_page_count(session)
         # API limits tags to 99 pages
         if self.pages > 99:
             self.pages = 99
@@ -674,6 +836,13 @@ class Tag(BaseContainer):
 class Search(BaseContainer):
     """Store and parse searches."""
     type = "search"
+    # Sort orders and their API equivalent
+    methods = {
+        'relevance': None,
+        'top': "likes_count",
+        'views_count': "views_count",
+        'most_recent': "newest"
+    }
 
     def __init__(self, id_):
         super(Search, self).__init__(id_)
@@ -684,24 +853,17 @@ class Search(BaseContainer):
 
     def get_template(self):
         """Return API request template for coub searches."""
-        methods = {
-            'relevance': None,
-            'top': "likes_count",
-            'views_count': "views_count",
-            'most_recent': "newest"
-        }
-
         template = f"https://coub.com/api/v2/search/coubs?q={urlquote(self.id)}"
         template = f"{template}&per_page={opts.coubs_per_page}"
 
-        if self.sort not in methods:
+        if self.sort not in self.methods:
             err(f"\nInvalid search sort order '{self.sort}' ({self.id})!",
                 color=fgcolors.WARNING)
             self.valid = False
         # The default tab on coub.com is labelled "Relevance", but the
         # default sort order is actually no sort order
         elif self.sort != "relevance":
-            template = f"{template}&order_by={methods[self.sort]}"
+            template = f"{template}&order_by={self.methods[self.sort]}"
 
         self.template = template
 
@@ -709,6 +871,34 @@ class Search(BaseContainer):
 class Community(BaseContainer):
     """Store and parse communities."""
     type = "community"
+    # Every sort order maps directly to the rest of the API URL
+    # {name} gets replaced by the quoted community name, {raw} by the name
+    # as given (random has always used it unquoted)
+    methods = {
+        'hot_daily': "community/{name}/daily?",
+        'hot_weekly': "community/{name}/weekly?",
+        'hot_monthly': "community/{name}/monthly?",
+        'hot_quarterly': "community/{name}/quarter?",
+        'hot_six_months': "community/{name}/half?",
+        'rising': "community/{name}/rising?",
+        'fresh': "community/{name}/fresh?",
+        'top': "community/{name}/fresh?order_by=likes_count&",
+        'views_count': "community/{name}/fresh?order_by=views_count&",
+        'random': "random/{raw}?",
+    }
+    # Featured and Coub of the Day use their own timelines
+    timelines = {
+        'featured': {
+            'recent': "explore?",
+            'top_of_the_month': "explore?order_by=top_of_the_month&",
+            'undervalued': "explore?order_by=undervalued&",
+        },
+        'coub-of-the-day': {
+            'recent': "explore/coub_of_the_day?",
+            'top': "explore/coub_of_the_day?order_by=top&",
+            'views_count': "explore/coub_of_the_day?order_by=views_count&",
+        },
+    }
 
     def __init__(self, id_):
         super(Community, self).__init__(id_)
@@ -716,63 +906,27 @@ class Community(BaseContainer):
         #                 hot_six_months, rising, fresh, top, views_count, random
         # Coub's default: hot_monthly
         if not self.sort:
-            if self.id in ("featured", "coub-of-the-day"):
+            if self.id in {"featured", "coub-of-the-day"}:
                 self.sort = "recent"
             else:
                 self.sort = "hot_monthly"
 
     def get_template(self):
         """Return API request template for communities."""
-        if self.id == "featured":
-            methods = {
-                'recent': None,
-                'top_of_the_month': "top_of_the_month",
-                'undervalued': "undervalued",
-            }
-            template = "https://coub.com/api/v2/timeline/explore?"
-        elif self.id == "coub-of-the-day":
-            methods = {
-                'recent': None,
-                'top': "top",
-                'views_count': "views_count",
-            }
-            template = "https://coub.com/api/v2/timeline/explore/coub_of_the_day?"
-        else:
-            methods = {
-                'hot_daily': "daily",
-                'hot_weekly': "weekly",
-                'hot_monthly': "monthly",
-                'hot_quarterly': "quarter",
-                'hot_six_months': "half",
-                'rising': "rising",
-                'fresh': "fresh",
-                'top': "likes_count",
-                'views_count': "views_count",
-                'random': "random",
-            }
-            template = f"https://coub.com/api/v2/timeline/community/{urlquote(self.id)}"
-
-        if self.sort not in methods:
+        methods = self.timelines.get(self.id, self.methods)
+        path = methods.get(self.sort)
+        if path is None:
             err(f"\nInvalid community sort order '{self.sort}' ({self.id})!",
                 color=fgcolors.WARNING)
             self.valid = False
             return
 
-        if self.id in ("featured", "coub-of-the-day"):
-            if self.sort != "recent":
-                template = f"{template}order_by={methods[self.sort]}&"
-        else:
-            if self.sort in ("top", "views_count"):
-                template = f"{template}/fresh?order_by={methods[self.sort]}&"
-            elif self.sort == "random":
-                template = f"https://coub.com/api/v2/timeline/random/{self.id}?"
-            else:
-                template = f"{template}/{methods[self.sort]}?"
-
+        path = path.format(name=urlquote(self.id), raw=self.id)
+        template = f"https://coub.com/api/v2/timeline/{path}"
         self.template = f"{template}per_page={opts.coubs_per_page}"
 
-    def get_page_count(self):
-        super(Community, self).get_page_count()
+    async def get_page_count(self, session=None):
+        await super(Community, self).get_page_count(session)
         # API limits communities to 99 pages
         if self.pages > 99:
             self.pages = 99
@@ -781,6 +935,16 @@ class Community(BaseContainer):
 class HotSection(BaseContainer):
     """Store and parse the hot section."""
     type = "hot section"
+    # Sort orders and their API equivalent
+    methods = {
+        'hot_daily': "daily",
+        'hot_weekly': "weekly",
+        'hot_monthly': "monthly",
+        'hot_quarterly': "quarter",
+        'hot_six_months': "half",
+        'rising': "rising",
+        'fresh': "fresh",
+    }
 
     def __init__(self, sort=None):
         super(HotSection, self).__init__("hot")
@@ -794,20 +958,11 @@ class HotSection(BaseContainer):
 
     def get_template(self):
         """Return API request template for Coub's hot section."""
-        methods = {
-            'hot_daily': "daily",
-            'hot_weekly': "weekly",
-            'hot_monthly': "monthly",
-            'hot_quarterly': "quarter",
-            'hot_six_months': "half",
-            'rising': "rising",
-            'fresh': "fresh",
-        }
-
         template = "https://coub.com/api/v2/timeline/subscriptions"
 
-        if self.sort in methods:
-            template = f"{template}/{methods[self.sort]}"
+        order = self.methods.get(self.sort)
+        if order is not None:
+            template = f"{template}/{order}"
         else:
             err(f"\nInvalid hot section sort order '{self.sort}'!",
                 color=fgcolors.WARNING)
@@ -817,8 +972,8 @@ class HotSection(BaseContainer):
 
         self.template = template
 
-    def get_page_count(self):
-        super(HotSection, self).get_page_count()
+    async def get_page_count(self, session=None):
+        await super(HotSection, self).get_page_count(session)
         # API limits hot section to 99 pages
         if self.pages > 99:
             self.pages = 99
@@ -827,6 +982,11 @@ class HotSection(BaseContainer):
 class RandomCategory(BaseContainer):
     """Store and parse the random category."""
     type = "random"
+    # Sort orders and their API equivalent
+    methods = {
+        'popular': None,
+        'top': "top",
+    }
 
     def __init__(self, sort=None):
         super(RandomCategory, self).__init__("random")
@@ -839,19 +999,15 @@ class RandomCategory(BaseContainer):
 
     def get_template(self):
         """Return API request template for Coub's random category."""
-        methods = {
-            'popular': None,
-            'top': "top",
-        }
         template = "https://coub.com/api/v2/timeline/explore/random?"
 
-        if self.sort not in methods:
+        if self.sort not in self.methods:
             err(f"\nInvalid random sort order '{self.sort}'!",
                 color=fgcolors.WARNING)
             self.valid = False
             return
         if self.sort == "top":
-            template = f"{template}order_by={methods[self.sort]}&"
+            template = f"{template}order_by={self.methods[self.sort]}&"
 
         self.template = f"{template}per_page={opts.coubs_per_page}"
 
@@ -864,23 +1020,16 @@ class LinkList:
         self.id = valid_list(path)
         self.sort = None
 
-    async def process(self, quantity=None):
+    async def process(self, quantity=None, session=None):
         """Parse coub links provided in via an external text file."""
         msg(f"\nReading input list ({self.id}):")
 
+        # A single regex scan both finds coub links and extracts their ID
+        # IDs end at any whitespace, which emulates wordsplitting in Bash
+        links = []
         with open(self.id, "r") as f:
-            content = f.read()
-
-        # Replace tabs and spaces with newlines
-        # Emulates default wordsplitting in Bash
-        content = content.replace("\t", "\n")
-        content = content.replace(" ", "\n")
-        content = content.splitlines()
-
-        links = [
-            l.partition("https://coub.com/view/")[2]
-            for l in content if "https://coub.com/view/" in l
-        ]
+            for line in f:
+                links.extend(list_links.findall(line))
         msg(f"  {len(links)} link{'s' if len(links) != 1 else ''} found")
 
         if quantity:
@@ -891,10 +1040,12 @@ class LinkList:
 class Coub:
     """Store all relevant infos and methods to process a single coub."""
 
-    def __init__(self, c_id):
+    def __init__(self, c_id, info=None):
         self.id = c_id
         self.link = f"https://coub.com/view/{self.id}"
         self.req = f"https://coub.com/api/v2/coubs/{self.id}"
+        # API infos taken from a timeline page (if available)
+        self.info = info
 
         self.v_link = None
         self.a_link = None
@@ -935,18 +1086,20 @@ class Coub:
         if self.erroneous():
             return
 
-        if aio:
+        if self.info:
+            resp_json = self.info
+            self.info = None
+        elif aio:
             async with session.get(self.req) as resp:
-                resp_json = await resp.read()
-                resp_json = json.loads(resp_json)
+                resp_json = json_loads(await resp.read())
         else:
+            loop = asyncio.get_running_loop()
             try:
-                with urlopen(self.req) as resp:
-                    resp_json = resp.read()
-                    resp_json = json.loads(resp_json)
+                resp_json = await loop.run_in_executor(None, read_url, self.req)
             except (urllib.error.HTTPError, urllib.error.URLError):
                 self.unavailable = True
                 return
+            resp_json = json_loads(resp_json)
 
         v_list, a_list = stream_lists(resp_json)
         if v_list:
@@ -966,7 +1119,7 @@ class Coub:
         if not opts.a_only:
             self.v_name = f"{self.name}.mp4"
         if not opts.v_only and self.a_link:
-            a_ext = self.a_link.split(".")[-1]
+            a_ext = self.a_link.rpartition(".")[2]
             self.a_name = f"{self.name}.{a_ext}"
 
     async def download(self, session=None):
@@ -983,7 +1136,7 @@ class Coub:
         tasks = [save_stream(s[0], s[1], session) for s in streams]
         await asyncio.gather(*tasks)
 
-    def check_integrity(self):
+    async def check_integrity(self):
         """Test if a coub was downloaded successfully (e.g. no corruption)."""
         if self.erroneous():
             return
@@ -1001,18 +1154,18 @@ class Coub:
                 self.corrupted = True
             return
 
-        if self.v_name and not valid_stream(self.v_name) or \
-           self.a_name and not valid_stream(self.a_name):
-
-            if self.v_name and os.path.exists(self.v_name):
-                os.remove(self.v_name)
-            if self.a_name and os.path.exists(self.a_name):
-                os.remove(self.a_name)
+        # Test all streams at once
+        streams = [s for s in (self.v_name, self.a_name) if s]
+        results = await asyncio.gather(*[valid_stream(s) for s in streams])
+        if not all(results):
+            for s in streams:
+                with suppress(FileNotFoundError):
+                    os.remove(s)
 
             self.corrupted = True
             return
 
-    def merge(self):
+    async def merge(self):
         """Mux the separate video/audio streams with FFmpeg."""
         if self.erroneous():
             return
@@ -1022,29 +1175,21 @@ class Coub:
             return
 
         m_name = f"{self.name}.{opts.merge_ext}"     # merged name
-        t_name = f"{self.name}.txt"                  # txt name
 
-        try:
-            # Print .txt for FFmpeg's concat
-            with open(t_name, "w", encoding="utf-8") as f:
-                for _ in range(opts.repeat):
-                    print(f"file 'file:{self.v_name}'", file=f)
-
-            # Loop footage until shortest stream ends
-            # Concatenated video (via list) counts as one long stream
-            command = [
-                opts.ffmpeg_path, "-y", "-v", "error",
-                "-f", "concat", "-safe", "0",
-                "-i", f"file:{t_name}", "-i", f"file:{self.a_name}",
-            ]
-            if opts.duration:
-                command.extend(["-t", opts.duration])
-            command.extend(["-c", "copy", "-shortest", f"file:temp_{m_name}"])
-
-            subprocess.run(command, check=False)
-        finally:
-            if os.path.exists(t_name):
-                os.remove(t_name)
+        # Loop footage until shortest stream ends
+        # -stream_loop counts additional loops, i.e. 0 plays the video once
+        command = [
+            opts.ffmpeg_path, "-y", "-v", "error",
+            "-stream_loop", str(opts.repeat - 1), "-i", f"file:{self.v_name}",
+            "-i", f"file:{self.a_name}",
+        ]
+        if opts.duration:
+            command.extend(["-t", opts.duration])
+        command.extend(["-c", "copy", "-shortest", f"file:temp_{m_name}"])
+
+        async with ffmpeg_slots:
+            proc = await asyncio.create_subprocess_exec(*command)
+            await finish_process(proc)
 
         # Merging would break when using <...>.mp4 both as input and output
         os.replace(f"temp_{m_name}", m_name)
@@ -1056,15 +1201,22 @@ class Coub:
 
     def archive(self):
         """Log a coub's ID in the archive file."""
+        global archive_file
+
         # This return also prevents users from creating new archive files
         # from already existing coub collections
         if self.erroneous():
             return
 
-        with open(opts.archive, "a") as f:
-            print(self.id, file=f)
+        # Only opened once it's actually needed (see above)
+        # Line buffering still writes every ID as soon as it gets archived
+        if archive_file is None:
+            archive_file = open(opts.archive, "a", buffering=1)
+        print(self.id, file=archive_file)
+        # Keep the in-memory copy in sync with the file
+        opts.archive_content.add(self.id)
 
-    def preview(self):
+    async def preview(self):
         """Play a coub with the user provided command."""
         if self.erroneous():
             return
@@ -1076,19 +1228,21 @@ class Coub:
         elif self.a_name:
             play = self.a_name
 
-        try:
-            # Need to split command string into list for check_call
-            command = opts.preview.split(" ")
-            command.append(play)
-            subprocess.check_call(command, stdout=subprocess.DEVNULL, \
-                                           stderr=subprocess.DEVNULL)
-        except (subprocess.CalledProcessError, FileNotFoundError):
+        # Downloads continue in the meantime, but only one coub plays at once
+        command = opts.preview_command + [play]
+        async with preview_lock:
+            try:
+                proc = await asyncio.create_subprocess_exec(
+                    *command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+                await finish_process(proc)
+                failed = proc.returncode != 0
+            except FileNotFoundError:
+                failed = True
+        if failed:
             err("Warning: Preview command failed!", color=fgcolors.WARNING)
 
-    async def process(self, session=None):
-        """Process a single coub."""
-        global count, done
-
+    async def fetch(self, session=None):
+        """Get the coub's infos and download its streams."""
         # 1st existence check
         # Handles default naming scheme and archive usage
         self.check_existence()
@@ -1103,65 +1257,79 @@ class Coub:
         # Download
         await self.download(session)
 
-        # Postprocessing stage
-        self.check_integrity()
+    async def postprocess(self):
+        """Check, merge and log an already downloaded coub."""
+        global count, done
+
+        await self.check_integrity()
         if not (opts.v_only or opts.a_only):
-            self.merge()
+            await self.merge()
 
         # Success should be logged as soon as possible to avoid deletion
         # of valid streams with special format options (e.g. --video-only)
         self.done = True
 
+        # Coubs later in the queue may end up with the same name
+        if not self.erroneous():
+            existing_files.update(os.path.normcase(n) for n in self.outputs())
+
         if opts.archive:
             self.archive()
         if opts.preview:
-            self.preview()
+            await self.preview()
 
         # Log status after processing
         count += 1
-        progress = f"[{count: >{len(str(total))}}/{total}]"
+        line = status_line.format(count, self.link)
         if self.unavailable:
-            err(f"  {progress} {self.link: <30} ... ", color=fgcolors.RESET, end="")
+            err(line, color=fgcolors.RESET, end="")
             err("unavailable")
         elif self.corrupted:
-            err(f"  {progress} {self.link: <30} ... ", color=fgcolors.RESET, end="")
+            err(line, color=fgcolors.RESET, end="")
             err("failed to download")
         elif self.exists:
             done += 1
-            msg(f"  {progress} {self.link: <30} ... ", end="")
+            msg(line, end="")
             msg("exists", color=fgcolors.WARNING)
         else:
             done += 1
-            msg(f"  {progress} {self.link: <30} ... ", end="")
+            msg(line, end="")
             msg("finished", color=fgcolors.SUCCESS)
 
+    def outputs(self):
+        """Return the names of all files left behind by a finished coub."""
+        # Separate streams only get merged if both were downloaded
+        if not (self.v_name and self.a_name):
+            return (self.v_name or self.a_name,)
+
+        m_name = f"{self.name}.{opts.merge_ext}"
+        if opts.keep:
+            return (m_name, self.v_name, self.a_name)
+        return (m_name,)
+
     def delete(self):
         """Delete any leftover streams."""
-        if self.v_name and os.path.exists(self.v_name):
-            os.remove(self.v_name)
-        if self.a_name and os.path.exists(self.a_name):
-            os.remove(self.a_name)
+        for s in (self.v_name, self.a_name):
+            if s:
+                with suppress(FileNotFoundError):
+                    os.remove(s)
 
 
 # ~~~~~~~~~~~~~~~~~~~~~~~~~~~~
 # Functions
 # ~~~~~~~~~~~~~~~~~~~~~~~~~~~~
 
-def err(*args, color=fgcolors.ERROR, **kwargs):
+def err(*args, color=fgcolors.ERROR, sep=" ", end="\n"):
     """Print to stderr."""
-    sys.stderr.write(color)
-    print(*args, file=sys.stderr, **kwargs)
-    sys.stderr.write(fgcolors.RESET)
-    sys.stdout.write(fgcolors.RESET)
+    # Colors and message are written at once instead of in several writes
+    sys.stderr.write(f"{color}{sep.join(map(str, args))}{end}{fgcolors.RESET}")
 
 
-def msg(*args, color=fgcolors.RESET, **kwargs):
+def msg(*args, color=fgcolors.RESET, sep=" ", end="\n"):
     """Print to stdout based on verbosity level."""
-    if opts.verbosity >= 1:
-        sys.stdout.write(color)
-        print(*args, **kwargs)
-        sys.stderr.write(fgcolors.RESET)
-        sys.stdout.write(fgcolors.RESET)
+    if opts.verbosity < 1:
+        return
+    sys.stdout.write(f"{color}{sep.join(map(str, args))}{end}{fgcolors.RESET}")
 
 
 def check_prereq():
@@ -1178,6 +1346,13 @@ def check_prereq():
 
 def check_connection():
     """Check if user can connect to coub.com."""
+    global last_connection
+
+    # A connection that just worked doesn't need to be tested again
+    # Saves a full HTTPS handshake on quickly repeated retries
+    if time.monotonic() - last_connection < 30:
+        return
+
     try:
         urlopen("https://coub.com/")
     except urllib.error.URLError as e:
@@ -1187,6 +1362,8 @@ def check_connection():
             err("Unable to connect to coub.com! Please check your connection.")
         sys.exit(status.CONN)
 
+    last_connection = time.monotonic()
+
 
 def no_url(string):
     """Test if direct input is an URL."""
@@ -1207,19 +1384,10 @@ def positive_int(string):
 
 
 def valid_time(string):
-    """Test valditiy of time syntax with FFmpeg."""
-    # Gets called in parse_cli, so opts.ffmpeg_path isn't available yet
-    # Exploits the fact that advanced defaults and options are always the same
-    defaults = DefaultOptions()
-    command = [
-        defaults.FFMPEG_PATH, "-v", "quiet",
-        "-f", "lavfi", "-i", "anullsrc",
-        "-t", string, "-c", "copy",
-        "-f", "null", "-",
-    ]
-    try:
-        subprocess.check_call(command)
-    except subprocess.CalledProcessError:
+    """Test valditiy of time syntax (FFmpeg's time duration format)."""
+    # https://ffmpeg.org/ffmpeg-utils.html#time-duration-syntax
+    # Checking it in Python saves spawning an FFmpeg process just for this
+    if not time_syntax.fullmatch(string):
         raise argparse.ArgumentTypeError("invalid time syntax")
 
     return string
@@ -1255,42 +1423,6 @@ def valid_archive(string):
 
 def normalize_link(string):
     """Format link to guarantee strict adherence to https://coub.com/<info>#<sort>"""
-    to_replace = {
-        'channel': {
-            '/coubs': None,
-            '/reposts': None,
-            '/stories': None,
-        },
-        'tag': {
-            '/likes': "top",
-            '/views': "views_count",
-            '/fresh': "fresh"
-        },
-        'search': {
-            '/likes': "top",
-            '/views': "views_count",
-            '/fresh': "most_recent",
-            '/channels': None,
-        },
-        'community': {
-            '/rising': "rising",
-            '/fresh': "fresh",
-            '/top': "top",
-            '/views': "views_count",
-            '/random': "random",
-        },
-        'featured': {
-            'featured/coubs/top_of_the_month': "top_of_the_month",
-            'featured/coubs/undervalued': "undervalued",
-            'featured/stories': None,
-            'featured/channels': None,
-            'featured': "recent",
-        },
-        'random': {
-            '/top': "top",
-        },
-    }
-
     try:
         link, sort = string.split("#")
     except ValueError:
@@ -1301,52 +1433,52 @@ def normalize_link(string):
     info = info.strip("/")
 
     if "tags/" in info:
-        for r in to_replace['tag']:
+        for r, r_sort in link_suffixes['tag']:
             parts = info.partition(r)
             if parts[1]:
                 if not sort:
-                    sort = to_replace['tag'][r]
+                    sort = r_sort
                 info = parts[0]
     # If search is followed by ?q= then it shouldn't have any suffixes anyway
     elif "search/" in info:
-        for r in to_replace['search']:
+        for r, r_sort in link_suffixes['search']:
             parts = info.partition(r)
             if parts[1]:
                 if not sort:
-                    sort = to_replace['search'][r]
+                    sort = r_sort
                 info = f"{parts[0]}{parts[2]}"
     elif "community/" in info:
-        for r in to_replace['community']:
+        for r, r_sort in link_suffixes['community']:
             parts = info.partition(r)
             if parts[1]:
                 if not sort:
-                    sort = to_replace['community'][r]
+                    sort = r_sort
                 info = parts[0]
     elif "featured" in info:
-        for r in to_replace['featured']:
+        for r, r_sort in link_suffixes['featured']:
             parts = info.partition(r)
             if parts[1]:
                 if not sort:
-                    sort = to_replace['featured'][r]
+                    sort = r_sort
                 info = "community/featured"
     elif "random" in info:
-        for r in to_replace['random']:
+        for r, r_sort in link_suffixes['random']:
             parts = info.partition(r)
             if parts[1]:
                 if not sort:
-                    sort = to_replace['random'][r]
+                    sort = r_sort
                 info = parts[0]
     # These are the 2 special cases for the hot section
-    elif info in ("rising", "fresh"):
+    elif info in {"rising", "fresh"}:
         if not sort:
             sort = info
         info = ""
     else:
-        for r in to_replace['channel']:
+        for r, r_sort in link_suffixes['channel']:
             parts = info.partition(r)
             if parts[1]:
                 if not sort:
-                    sort = to_replace['channel'][r]
+                    sort = r_sort
                 info = parts[0]
 
     if info:
@@ -1364,32 +1496,33 @@ def mapped_input(string):
     # Categorize existing paths as lists
     # Otherwise the paths would be forced into a coub link like form
     # which obviously leads to garbled nonsense
+    # LinkList() validates the path itself
     if os.path.exists(string):
-        path = valid_list(string)
-        return LinkList(path)
+        return LinkList(string)
 
     link = normalize_link(string)
-
-    if "https://coub.com/view/" in link:
-        source = link.partition("https://coub.com/view/")[2]
-    elif "https://coub.com/tags/" in link:
-        name = link.partition("https://coub.com/tags/")[2]
+    # Normalized links always start with https://coub.com, so the link type
+    # only depends on what follows and simple prefix tests are enough
+    path = link[len("https://coub.com"):]
+
+    if path.startswith("/view/"):
+        source = path[len("/view/"):]
+    elif path.startswith("/tags/"):
+        name = path[len("/tags/"):]
         source = Tag(name)
-    elif "https://coub.com/search?q=" in link:
-        term = link.partition("https://coub.com/search?q=")[2]
+    elif path.startswith("/search?q="):
+        term = path[len("/search?q="):]
         source = Search(term)
-    elif "https://coub.com/community/" in link:
-        name = link.partition("https://coub.com/community/")[2]
+    elif path.startswith("/community/"):
+        name = path[len("/community/"):]
         source = Community(name)
-    elif "https://coub.com/random" in link:
+    elif path.startswith("/random"):
         try:
             _, sort = link.split("#")
         except ValueError:
             sort = None
         source = RandomCategory(sort)
-    elif "https://coub.com/hot" in link or \
-         "https://coub.com#" in link or \
-         link.strip("/") == "https://coub.com":
+    elif path.startswith(("/hot", "#")) or not path.strip("/"):
         try:
             _, sort = link.split("#")
         except ValueError:
@@ -1411,18 +1544,17 @@ def parse_cli():
 
     # Input
     parser.add_argument("raw_input", nargs="*", type=mapped_input)
-    parser.add_argument("-i", "--id", dest="input", action="append",
-                        type=no_url)
-    parser.add_argument("-l", "--list", dest="input", action="append",
-                        type=LinkList)
-    parser.add_argument("-c", "--channel", dest="input", action="append",
-                        type=Channel)
-    parser.add_argument("-t", "--tag", dest="input", action="append",
-                        type=Tag)
-    parser.add_argument("-e", "--search", dest="input", action="append",
-                        type=Search)
-    parser.add_argument("-m", "--community", dest="input", action="append",
-                        type=Community)
+    input_options = [
+        ("-i", "--id", no_url),
+        ("-l", "--list", LinkList),
+        ("-c", "--channel", Channel),
+        ("-t", "--tag", Tag),
+        ("-e", "--search", Search),
+        ("-m", "--community", Community),
+    ]
+    for short, long, source in input_options:
+        parser.add_argument(short, long, dest="input", action="append",
+                            type=source)
     parser.add_argument("--hot", dest="input", action="append_const",
                         const=HotSection())
     parser.add_argument("--random", "--random#popular", dest="input",
@@ -1464,9 +1596,9 @@ def parse_cli():
     a_qual.add_argument("--worstaudio", dest="a_quality", action="store_const",
                         const=0, default=defaults.A_QUALITY)
     parser.add_argument("--max-video", dest="v_max", default=defaults.V_MAX,
-                        choices=["med", "high", "higher"])
+                        choices=video_formats)
     parser.add_argument("--min-video", dest="v_min", default=defaults.V_MIN,
-                        choices=["med", "high", "higher"])
+                        choices=video_formats)
     aac = parser.add_mutually_exclusive_group()
     aac.add_argument("--aac", action="store_const", const=2, default=defaults.AAC)
     aac.add_argument("--aac-strict", dest="aac", action="store_const", const=3,
@@ -1497,7 +1629,7 @@ def parse_cli():
                         default=defaults.ARCHIVE)
     # Output
     parser.add_argument("--ext", dest="merge_ext", default=defaults.MERGE_EXT,
-                        choices=["mkv", "mp4", "asf", "avi", "flv", "f4v", "mov"])
+                        choices=merge_exts)
     parser.add_argument("-o", "--output", dest="name_template",
                         default=defaults.NAME_TEMPLATE)
 
@@ -1532,6 +1664,11 @@ def parse_cli():
     # but internally the default value is None
     if args.name_template == "%id%":
         args.name_template = None
+    # Remember which special strings are used, so get_name() can skip the rest
+    args.name_fields = template_fields(args.name_template)
+    # Need to split command string into an argument list for the subprocess
+    # Only done once instead of for every single coub
+    args.preview_command = args.preview.split(" ") if args.preview else []
     # Defining whitespace or an empty string in the config isn't possible
     # Instead translate appropriate keywords
     if args.tag_sep == "space":
@@ -1540,59 +1677,188 @@ def parse_cli():
         args.fallback_char = ""
     elif args.fallback_char == "space":
         args.fallback_char = " "
+    # Translation table to replace all forbidden characters at once
+    args.forbidden_table = str.maketrans(
+        dict.fromkeys(forbidden_chars, args.fallback_char))
+    # Extensions checked by exists() don't change between coubs
+    args.output_exts = output_exts(args)
+    # Same for the allowed video formats
+    args.v_formats = allowed_formats(args.v_min, args.v_max)
 
     return args
 
 
+def template_fields(template):
+    """Return the special strings used in the given name template."""
+    if not template:
+        return set()
+    return {s for s in name_specials if s in template}
+
+
+def allowed_formats(v_min, v_max):
+    """Return the video formats between the given limits (worst to best)."""
+    return video_formats[video_ranks[v_min]:video_ranks[v_max]+1]
+
+
+def output_exts(options):
+    """Return the possible extensions of a finished coub."""
+    if options.v_only or options.share:
+        return ("mp4",)
+    if options.a_only:
+        # exists() gets called before and after the API request was made
+        # Unless MP3 or AAC audio are strictly prohibited, there's no way to
+        # tell the final extension before the API request
+        exts = ()
+        if options.aac > 0:
+            exts += ("m4a",)
+        if options.aac < 3:
+            exts += ("mp3",)
+        return exts
+    return (options.merge_ext,)
+
+
 def check_options():
     """Test the user input (command line) for its validity."""
-    formats = {'med': 0, 'high': 1, 'higher': 2}
-    if formats[opts.v_min] > formats[opts.v_max]:
+    if video_ranks[opts.v_min] > video_ranks[opts.v_max]:
         err("Quality of --min-quality greater than --max-quality!")
         sys.exit(status.OPT)
 
 
 def resolve_paths():
     """Change into (and create) the destination directory."""
-    if not os.path.exists(opts.path):
-        os.makedirs(opts.path)
-    os.chdir(opts.path)
+    global name_max
+
+    try:
+        os.makedirs(opts.path, exist_ok=True)
+        os.chdir(opts.path)
+    except OSError:
+        err(f"Error: Unable to access destination directory '{opts.path}'!")
+        sys.exit(status.OPT)
+
+    # List the destination once instead of probing it for every coub
+    with os.scandir() as entries:
+        existing_files.update(os.path.normcase(e.name) for e in entries)
+
+    # Ask the destination's filesystem for its actual name length limit
+    # Not available on Windows, which keeps the default
+    # -1 means there's no fixed limit
+    with suppress(AttributeError, OSError, ValueError):
+        limit = os.pathconf(".", "PC_NAME_MAX")
+        if limit > 0:
+            name_max = limit
 
 
 async def parse_page(req, session=None):
     """Request a single timeline page and parse its content."""
     if aio:
         async with session.get(req) as resp:
-            resp_json = await resp.read()
-            resp_json = json.loads(resp_json)
+            resp_json = json_loads(await resp.read())
     else:
-        with urlopen(req) as resp:
-            resp_json = resp.read()
-            resp_json = json.loads(resp_json)
+        loop = asyncio.get_running_loop()
+        resp_json = json_loads(await loop.run_in_executor(None, read_url, req))
+
+    ids = []
+    for c in resp_json['coubs']:
+        if c['recoub_to']:
+            c = c['recoub_to']
+        ids.append(c['permalink'])
+        # Timeline pages already contain the same infos as a request to
+        # the coub API, so keep them to save a request per coub later
+        info = timeline_info(c)
+        if info:
+            timeline_infos[c['permalink']] = info
 
-    ids = [
-        c['recoub_to']['permalink'] if c['recoub_to'] else c['permalink']
-        for c in resp_json['coubs']
-    ]
     return ids
 
 
+def timeline_info(c):
+    """Reduce a timeline entry to the infos stream_lists() and get_name() use."""
+    # Entries stay in memory until their coub gets parsed, so everything
+    # else (descriptions, images, etc.) gets dropped right away
+    fields = opts.name_fields
+    try:
+        versions = c['file_versions']
+        info = {'file_versions': {v: versions[v] for v in timeline_versions}}
+        if '%title%' in fields:
+            info['title'] = c['title']
+        if '%creation%' in fields:
+            info['created_at'] = c['created_at']
+        if '%channel%' in fields:
+            info['channel'] = {'title': c['channel']['title']}
+        if '%tags%' in fields:
+            info['tags'] = [{'title': t['title']} for t in c['tags']]
+        if '%community%' in fields:
+            communities = c['communities']
+    except (KeyError, TypeError):
+        # Missing infos get requested from the coub API instead
+        return None
+
+    if '%community%' in fields:
+        # get_name() falls back to "undefined" without it
+        with suppress(KeyError, TypeError, IndexError):
+            info['communities'] = [{'permalink': communities[0]['permalink']}]
+
+    return info
+
+
+async def gather_tasks(coros):
+    """Run coroutines concurrently and cancel the rest if one fails."""
+    tasks = [asyncio.ensure_future(c) for c in coros]
+    try:
+        return await asyncio.gather(*tasks)
+    finally:
+        # Don't leave tasks running in the background (e.g. during a retry)
+        for t in tasks:
+            t.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+
 def remove_container_dupes(containers):
     """Remove duplicate containers to avoid unnecessary parsing."""
     no_dupes = []
-    # Brute-force sorting
+    seen = set()
     for c in containers:
-        unique = True
-        for u in no_dupes:
-            if (c.type, c.id, c.sort) == (u.type, u.id, u.sort):
-                unique = False
-        if unique or c.type == "random":
+        key = (c.type, c.id, c.sort)
+        if key not in seen or c.type == "random":
+            seen.add(key)
             no_dupes.append(c)
 
     return no_dupes
 
 
-def parse_input(sources):
+async def parse_containers(containers, found=0, session=None):
+    """Parse all containers one after another."""
+    # Page counts only take a single request per container, so get them
+    # all at once instead of waiting for each container in turn
+    timelines = [c for c in containers if isinstance(c, BaseContainer)]
+    await gather_tasks([c.prepare(session) for c in timelines])
+
+    ids = []
+    if aio and not opts.max_coubs:
+        # Without a limit every container gets parsed anyway, so do it all
+        # at once (the connection limit still applies)
+        # Only with aiohttp, as urllib reports progress page by page, which
+        # would mix the output of different containers
+        results = await gather_tasks([c.process(session=session)
+                                      for c in containers])
+        for r in results:
+            ids.extend(r)
+        return ids
+
+    # Remaining number of links until the download limit is reached
+    rest = opts.max_coubs - found if opts.max_coubs else None
+    for c in containers:
+        if rest is not None and rest <= 0:
+            break
+        new_ids = await c.process(rest, session)
+        ids.extend(new_ids)
+        if rest is not None:
+            rest -= len(new_ids)
+
+    return ids
+
+
+async def parse_input(sources, session=None):
     """Handle the parsing process of all provided input sources."""
     directs = [s for s in sources if isinstance(s, str)]
     containers = [s for s in sources if not isinstance(s, str)]
@@ -1608,14 +1874,7 @@ def parse_input(sources):
         msg(f"  {len(parsed)} link{'s' if len(parsed) != 1 else ''} found")
 
     # And now all containers
-    for c in containers:
-        if opts.max_coubs:
-            rest = opts.max_coubs - len(parsed)
-            if not rest:
-                break
-            parsed.extend(asyncio.run(c.process(rest)))
-        else:
-            parsed.extend(asyncio.run(c.process()))
+    parsed.extend(await parse_containers(containers, len(parsed), session))
 
     if not parsed:
         err("\nNo coub links specified!", color=fgcolors.WARNING)
@@ -1626,7 +1885,8 @@ def parse_input(sources):
             color=fgcolors.WARNING)
 
     before = len(parsed)
-    parsed = list(set(parsed))      # Weed out duplicates
+    # Weed out duplicates, but keep the input order
+    parsed = list(dict.fromkeys(parsed))
     dupes = before - len(parsed)
     parsed = [i for i in parsed if i not in opts.archive_content]
     archived = before - dupes - len(parsed)
@@ -1657,42 +1917,50 @@ def write_list(ids):
 
 def get_name(req_json, c_id):
     """Assemble final output name of a given coub."""
-    if not opts.name_template:
+    template = opts.name_template
+    if not template:
         return c_id
 
-    specials = {
-        '%id%': c_id,
-        '%title%': req_json['title'],
-        '%creation%': req_json['created_at'],
-        '%channel%': req_json['channel']['title'],
-        '%tags%': opts.tag_sep.join([t['title'] for t in req_json['tags']]),
-    }
-    # Coubs don't necessarily belong to a community (although it's rare)
-    try:
-        specials['%community%'] = req_json['communities'][0]['permalink']
-    except (KeyError, TypeError, IndexError):
-        specials['%community%'] = "undefined"
-
-    name = opts.name_template
-    for to_replace in specials:
-        name = name.replace(to_replace, specials[to_replace])
-
-    # An attempt to remove the most blatant problematic characters
-    # Linux supports all except /, but \n and \t are only asking for trouble
-    # https://dwheeler.com/essays/fixing-unix-linux-filenames.html
-    # ' is problematic as it causes issues with FFmpeg's concat muxer
-    forbidden = ["\n", "\t", "'", "/"]
-    if os.name == "nt":
-        forbidden.extend(["<", ">", ":", "\"", "\\", "|", "?", "*"])
-    for to_replace in forbidden:
-        name = name.replace(to_replace, opts.fallback_char)
+    # Only look up the special strings actually used in the template
+    fields = opts.name_fields
+    specials = {}
+    if '%id%' in fields:
+        specials['%id%'] = c_id
+    if '%title%' in fields:
+        specials['%title%'] = req_json['title']
+    if '%creation%' in fields:
+        specials['%creation%'] = req_json['created_at']
+    if '%channel%' in fields:
+        specials['%channel%'] = req_json['channel']['title']
+    if '%tags%' in fields:
+        specials['%tags%'] = opts.tag_sep.join([t['title'] for t in req_json['tags']])
+    if '%community%' in fields:
+        # Coubs don't necessarily belong to a community (although it's rare)
+        try:
+            specials['%community%'] = req_json['communities'][0]['permalink']
+        except (KeyError, TypeError, IndexError):
+            specials['%community%'] = "undefined"
 
-    try:
-        # Add example extension to simulate the full name length
-        f = open(f"{name}.ext", "w")
-        f.close()
-        os.remove(f"{name}.ext")
-    except OSError:
+    # Replace all special strings in a single pass
+    # Also prevents replacing special strings inside of inserted values
+    name = name_pattern.sub(lambda m: specials[m.group(0)], template)
+
+    # Replace problematic characters (see forbidden_chars) in a single pass
+    name = name.translate(opts.forbidden_table)
+
+    # Add example extension to simulate the full name length
+    # Windows counts UTF-16 code units instead of bytes
+    if os.name == "nt":
+        length = len(f"{name}.ext".encode("utf-16-le")) // 2
+        # Windows also limits the full path, including merge's temporary
+        # file (temp_ prefix) and the terminating null character
+        path = os.path.abspath(f"temp_{name}.ext")
+        too_long = length > name_max or \
+                   len(path.encode("utf-16-le")) // 2 >= path_max
+    else:
+        too_long = len(f"{name}.ext".encode("utf-8")) > name_max
+    # Windows also refuses names ending with a dot or space
+    if not name or too_long or (os.name == "nt" and name[-1] in ". "):
         err(f"Error: Filename invalid or too long! Falling back to '{c_id}'",
             color=fgcolors.WARNING)
         name = c_id
@@ -1702,23 +1970,10 @@ def get_name(req_json, c_id):
 
 def exists(name):
     """Test if a video with the given name and requested extension exists."""
-    if opts.v_only or opts.share:
-        full_name = [f"{name}.mp4"]
-    elif opts.a_only:
-        # exists() gets called before and after the API request was made
-        # Unless MP3 or AAC audio are strictly prohibited, there's no way to
-        # tell the final extension before the API request
-        full_name = []
-        if opts.aac > 0:
-            full_name.append(f"{name}.m4a")
-        if opts.aac < 3:
-            full_name.append(f"{name}.mp3")
-    else:
-        full_name = [f"{name}.{opts.merge_ext}"]
-
-    for f in full_name:
-        if os.path.exists(f):
-            return f
+    for ext in opts.output_exts:
+        full_name = f"{name}.{ext}"
+        if os.path.normcase(full_name) in existing_files:
+            return full_name
 
     return None
 
@@ -1736,11 +1991,19 @@ def overwrite(name):
     print("1) yes")
     print("2) no")
     while True:
-        answer = input("#? ")
-        if answer == "1":
-            return True
-        if answer == "2":
-            return False
+        answer = input("#? ").strip().lower()
+        if answer in overwrite_answers:
+            return overwrite_answers[answer]
+
+
+def share_stream_lists(resp_json):
+    """Return the 'share' video stream (includes audio) of the given coub."""
+    version = resp_json['file_versions']['share']['default']
+    # Non-existence results in None or '{}' (the latter is rare)
+    if version and version != "{}":
+        return ([version], [])
+
+    return ([], [])
 
 
 def stream_lists(resp_json):
@@ -1796,67 +2059,59 @@ def stream_lists(resp_json):
     #
     # It's a mess. Also release an up-to-date API documentations, you dolts!
 
-    video = []
-    audio = []
-
     # In case Coub returns "error: Coub not found"
     if 'error' in resp_json:
         return ([], [])
 
+    # Shouldn't happen outside of errors, but there's nothing to parse then
+    versions = resp_json.get('file_versions')
+    if not versions:
+        return ([], [])
+
     # Special treatment for shared video
     if opts.share:
-        version = resp_json['file_versions']['share']['default']
-        # Non-existence results in None or '{}' (the latter is rare)
-        if version and version not in ("{}",):
-            return ([version], [])
+        return share_stream_lists(resp_json)
 
-        return ([], [])
+    video = []
+    audio = []
 
     # Video stream parsing
-    v_formats = {
-        'med': 0,
-        'high': 1,
-        'higher': 2,
-    }
-
-    v_max = v_formats[opts.v_max]
-    v_min = v_formats[opts.v_min]
-
-    version = resp_json['file_versions']['html5']['video']
-    for vq in v_formats:
-        if v_min <= v_formats[vq] <= v_max:
-            # html5 stream sizes can be 0 OR None in case of a missing stream
-            # None is the exception and an irregularity in the Coub API
-            if vq in version and version[vq]['size']:
-                video.append(version[vq]['url'])
+    version = versions['html5']['video']
+    for vq in opts.v_formats:
+        # html5 stream sizes can be 0 OR None in case of a missing stream
+        # None is the exception and an irregularity in the Coub API
+        stream = version.get(vq)
+        if stream and stream['size']:
+            video.append(stream['url'])
+
+    # Audio streams never get used for video-only downloads
+    if opts.v_only:
+        return (video, audio)
 
     # Audio stream parsing
-    if opts.aac >= 2:
-        a_combo = [
-            ("html5", "med"),
-            ("html5", "high"),
-            ("mobile", 0),
-        ]
-    else:
-        a_combo = [
-            ("html5", "med"),
-            ("mobile", 0),
-            ("html5", "high"),
-        ]
+    # Bound once, as it's checked for every audio version
+    aac = opts.aac
+    a_combo = audio_combos_aac if aac >= 2 else audio_combos
+
+    # Look up the audio versions only once instead of per combination
+    a_versions = {
+        form: versions[form].get('audio') for form in ("html5", "mobile")
+    }
 
     for form, aq in a_combo:
-        if 'audio' in resp_json['file_versions'][form]:
-            version = resp_json['file_versions'][form]['audio']
-        else:
+        version = a_versions[form]
+        if version is None:
             continue
 
         if form == "mobile":
-            if opts.aac:
+            if aac:
                 # Mobile audio doesn't list its size
                 # So just pray that the file behind the link exists
                 audio.append(version[aq])
-        elif aq in version and version[aq]['size'] and opts.aac < 3:
-            audio.append(version[aq]['url'])
+        elif aac < 3:
+            stream = version.get(aq)
+            if stream and stream['size']:
+                audio.append(stream['url'])
 
     return (video, audio)
 
@@ -1865,25 +2120,48 @@ async def save_stream(link, path, session=None):
     """Download a single media stream."""
     if aio:
         async with session.get(link) as stream:
-            with open(path, "wb") as f:
-                while True:
-                    chunk = await stream.content.read(opts.chunk_size)
-                    if not chunk:
-                        break
-                    f.write(chunk)
+            chunks = stream.content.iter_chunked(opts.chunk_size)
+            if aio_files:
+                # Writes don't block other downloads on slow disks
+                async with aiofiles.open(path, "wb") as f:
+                    async for chunk in chunks:
+                        await f.write(chunk)
+            else:
+                with open(path, "wb") as f:
+                    async for chunk in chunks:
+                        f.write(chunk)
     else:
+        loop = asyncio.get_running_loop()
         try:
-            with urlopen(link) as stream, open(path, "wb") as f:
-                while True:
-                    chunk = stream.read(opts.chunk_size)
-                    if not chunk:
-                        break
-                    f.write(chunk)
+            await loop.run_in_executor(None, copy_url, link, path)
         except (urllib.error.HTTPError, urllib.error.URLError):
             return
 
 
-def valid_stream(path, attempted_fix=False):
+def read_url(url):
+    """Return the content behind an URL (blocking)."""
+    with urlopen(url) as resp:
+        return resp.read()
+
+
+def copy_url(link, path):
+    """Save the content behind an URL to a file (blocking)."""
+    with urlopen(link) as stream, open(path, "wb") as f:
+        shutil.copyfileobj(stream, f, length=opts.chunk_size)
+
+
+async def finish_process(proc):
+    """Wait for a subprocess to end, but don't leave it behind if cancelled."""
+    try:
+        return await proc.communicate()
+    except asyncio.CancelledError:
+        with suppress(ProcessLookupError):
+            proc.kill()
+        await proc.wait()
+        raise
+
+
+async def valid_stream(path, attempted_fix=False):
     """Test a given stream for eventual corruption with a test remux (FFmpeg)."""
     command = [
         opts.ffmpeg_path, "-v", "error",
@@ -1891,51 +2169,77 @@ def valid_stream(path, attempted_fix=False):
         "-t", "1",
         "-f", "null", "-",
     ]
-    out = subprocess.run(command, capture_output=True, text=True, check=False)
+    # Limit the number of simultaneous FFmpeg instances
+    # Only stderr is of interest, so don't bother capturing stdout
+    async with ffmpeg_slots:
+        proc = await asyncio.create_subprocess_exec(
+            *command, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+        _, stderr = await finish_process(proc)
+    stderr = stderr.decode("utf-8", errors="replace")
 
     # Fix broken video stream
-    if "moov atom not found" in out.stderr and not attempted_fix:
+    if "moov atom not found" in stderr and not attempted_fix:
         with open(path, "r+b") as f:
             temp = f.read()
         with open(path, "w+b") as f:
             f.write(b'\x00\x00' + temp[2:])
-        return valid_stream(path, attempted_fix=True)
+        return await valid_stream(path, attempted_fix=True)
 
     # Checks against typical error messages in case of missing chunks
-    # "Header missing"/"Failed to read frame size" -> audio corruption
-    # "Invalid NAL" -> video corruption
-    # "moov atom not found" -> old Coub storage method
-    typical = [
-        "Header missing",
-        "Failed to read frame size",
-        "Invalid NAL",
-        "moov atom not found",
-    ]
-    for error in typical:
-        if error in out.stderr:
-            return False
-
-    return True
+    return stream_errors.search(stderr) is None
 
 
-async def process(coubs):
+async def process(coubs, session=None):
     """Call the process function of all parsed coubs."""
-    if aio:
-        tout = aiohttp.ClientTimeout(total=None)
-        conn = aiohttp.TCPConnector(limit=opts.connections)
-        try:
-            async with aiohttp.ClientSession(timeout=tout, connector=conn) as session:
-                tasks = [c.process(session) for c in coubs]
-                await asyncio.gather(*tasks)
-        except aiohttp.ClientConnectionError:
+    # Workers share one iterator, so only as many coubs as there are
+    # connections get downloaded at once (instead of creating a task for
+    # every single coub upfront)
+    queue = iter(coubs)
+    # Postprocessing (mostly FFmpeg) happens in separate workers, so
+    # downloaders can move on to the next coub in the meantime
+    downloaded = asyncio.Queue(maxsize=opts.connections)
+    fetchers = min(opts.connections, len(coubs))
+    finishers = min(os.cpu_count() or 1, len(coubs))
+
+    async def fetch_worker():
+        for c in queue:
+            await c.fetch(session)
+            await downloaded.put(c)
+
+    # Every worker gets its own task, so all of them can be cancelled
+    fetch_tasks = [asyncio.ensure_future(fetch_worker())
+                   for _ in range(fetchers)]
+
+    async def fetch_all():
+        await asyncio.gather(*fetch_tasks)
+        # Signal the end of the queue to every postprocessing worker
+        for _ in range(finishers):
+            await downloaded.put(None)
+
+    async def postprocess_worker():
+        while True:
+            c = await downloaded.get()
+            if c is None:
+                return
+            await c.postprocess()
+
+    tasks = fetch_tasks + [asyncio.ensure_future(fetch_all())]
+    tasks.extend(asyncio.ensure_future(postprocess_worker())
+                 for _ in range(finishers))
+    try:
+        await asyncio.gather(*tasks)
+    except Exception as e:
+        if aio and isinstance(e, aiohttp.ClientConnectionError):
             err("\nLost connection to coub.com!")
-            raise
-        except aiohttp.ClientPayloadError:
+        elif aio and isinstance(e, aiohttp.ClientPayloadError):
             err("\nReceived malformed data!")
-            raise
-    else:
-        for c in coubs:
-            await c.process()
+        raise
+    finally:
+        # The event loop survives failed attempts, so stop all remaining
+        # workers before the next attempt starts
+        for t in tasks:
+            t.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
 
 
 def clean(coubs):
@@ -1944,36 +2248,113 @@ def clean(coubs):
         c.delete()
 
 
-def attempt_process(coubs, level=0):
+def retry_delay(attempt):
+    """Return the seconds to wait before a given retry attempt."""
+    # Back off exponentially to not hammer an overloaded API
+    # Jitter keeps retries from different runs from lining up
+    return min(2 ** (attempt - 1), 30) + random.random()
+
+
+async def attempt_process(coubs, session=None):
     """Attempt to run the process function."""
-    if -1 < opts.retries < level:
-        err("Ran out of connection retries! Please check your connection.")
-        clean(coubs)
-        sys.exit(status.CONN)
+    level = 0
+    while True:
+        if -1 < opts.retries < level:
+            err("Ran out of connection retries! Please check your connection.")
+            clean(coubs)
+            sys.exit(status.CONN)
 
-    if level > 0:
-        err(f"Retrying... ({level} of "
-            f"{opts.retries if opts.retries > 0 else 'Inf'} attempts)",
-            color=fgcolors.WARNING)
+        if level > 0:
+            err(f"Retrying... ({level} of "
+                f"{opts.retries if opts.retries > 0 else 'Inf'} attempts)",
+                color=fgcolors.WARNING)
+            await asyncio.sleep(retry_delay(level))
+
+        try:
+            await process(coubs, session)
+            return
+        except json.decoder.JSONDecodeError:
+            err("\nCoub API temporarily not available!")
+        except Exception as e:
+            if not (aio and isinstance(e, (aiohttp.ClientConnectionError,
+                                           aiohttp.ClientPayloadError))):
+                raise
 
-    try:
-        asyncio.run(process(coubs), debug=False)
-    except json.decoder.JSONDecodeError:
-        err("\nCoub API temporarily not available!")
         check_connection()
         # Reduce the list of coubs to only those yet to finish
         coubs = [c for c in coubs if not c.done]
         level += 1
-        attempt_process(coubs, level)
-    except Exception as e:
-        if aio and isinstance(e, (aiohttp.ClientConnectionError, aiohttp.ClientPayloadError)):
-            check_connection()
-            # Reduce the list of coubs to only those yet to finish
-            coubs = [c for c in coubs if not c.done]
-            level += 1
-            attempt_process(coubs, level)
+
+
+async def download_coubs(coubs, session=None):
+    """Set up resources shared by all download attempts and start them."""
+    global ffmpeg_slots, preview_lock
+
+    # Must be created inside the running event loop
+    ffmpeg_slots = asyncio.Semaphore(os.cpu_count() or 1)
+    preview_lock = asyncio.Lock()
+
+    try:
+        await attempt_process(coubs, session)
+    finally:
+        if archive_file:
+            archive_file.close()
+
+
+async def run():
+    """Parse the input and download all coubs with one shared session."""
+    global total, status_line
+
+    session = None
+    if aio:
+        # The same session (and its connection pool) is used for every
+        # request, from the first timeline page to the last download retry
+        tout = aiohttp.ClientTimeout(total=None)
+        conn = aiohttp.TCPConnector(limit=opts.connections, ttl_dns_cache=300)
+        session = aiohttp.ClientSession(timeout=tout, connector=conn)
+    else:
+        # urllib blocks, so requests run in threads to still download
+        # several coubs at once
+        executor = ThreadPoolExecutor(max_workers=opts.connections)
+        asyncio.get_running_loop().set_default_executor(executor)
+
+    try:
+        msg("\n### Parse Input ###")
+
+        attempt = 0
+        ids = []
+        while opts.retries < 0 or attempt <= opts.retries:
+            try:
+                ids = await parse_input(opts.input, session)
+                break
+            except json.decoder.JSONDecodeError:
+                err("\nCoub API temporarily not available!")
+                check_connection()
+                attempt += 1
+                if opts.retries < 0 or attempt <= opts.retries:
+                    await asyncio.sleep(retry_delay(attempt))
+
+        if ids:
+            if opts.output_list:
+                write_list(ids)
+                sys.exit(0)
+            total = len(ids)
+            status_line = f"  [{{: >{len(str(total))}}}/{total}] {{: <30}} ... "
+            coubs = [Coub(i, timeline_infos.pop(i, None)) for i in ids]
+            timeline_infos.clear()
+
+            msg("\n### Download Coubs ###\n")
+            try:
+                await download_coubs(coubs, session)
+            finally:
+                clean(coubs)
+        elif opts.retries >= 0 and attempt > opts.retries:
+            err("\nRan out of connection retries! Please try again later.")
         else:
-            raise
+            msg("\nAll coubs present in archive file!", color=fgcolors.WARNING)
+    finally:
+        if session:
+            await session.close()
 
 # ~~~~~~~~~~~~~~~~~~~~~~~~~~~~
 # Main Function
@@ -1981,42 +2362,15 @@ def attempt_process(coubs, level=0):
 
 def main():
     """Download all requested coubs."""
-    global total
-
     check_prereq()
     check_options()
     resolve_paths()
     check_connection()
 
-    msg("\n### Parse Input ###")
-
-    attempt = 0
-    ids = []
-    while opts.retries < 0 or attempt <= opts.retries:
-        try:
-            ids = parse_input(opts.input)
-            break
-        except json.decoder.JSONDecodeError:
-            err("\nCoub API temporarily not available!")
-            check_connection()
-            attempt += 1
-
-    if ids:
-        if opts.output_list:
-            write_list(ids)
-            sys.exit(0)
-        total = len(ids)
-        coubs = [Coub(i) for i in ids]
-
-        msg("\n### Download Coubs ###\n")
-        try:
-            attempt_process(coubs)
-        finally:
-            clean(coubs)
-    elif opts.retries >= 0 and attempt > opts.retries:
-        err("\nRan out of connection retries! Please try again later.")
-    else:
-        msg("\nAll coubs present in archive file!", color=fgcolors.WARNING)
+    # Python 3.7's default event loop on Windows can't spawn subprocesses
+    if os.name == "nt":
+        asyncio.set_event_loop_policy(asyncio.WindowsProactorEventLoopPolicy())
+    asyncio.run(run(), debug=False)
 
     msg("\n### Finished ###\n")
 